@@ -1,9 +1,11 @@
 from __future__ import annotations
+import heapq
 import logging
 import threading
 import time
 from abc import ABCMeta, abstractmethod
 from enum import Enum
+from functools import lru_cache
 from threading import Thread
 from typing import *
 
@@ -23,50 +25,158 @@ from se.domain2.time_series.time_series import TimeSeriesRepo, HistoryDataQueryC
 import numpy as np
 
 
+@lru_cache(maxsize=None)
+def _market_times(calendar: TradingCalendar) -> Tuple[DatetimeIndex, DatetimeIndex]:
+    """
+    交易日历的开盘时间和收盘时间，每个交易日历只构造一次
+    :param calendar:
+    :return: (开盘时间, 收盘时间)
+    """
+    # 因为TradingCalendar默认的开盘时间是开盘后一分钟，所以这里做一下调整
+    market_opens = DatetimeIndex(calendar.opens.values, tz="UTC") - Timedelta(minutes=1)
+    market_closes = DatetimeIndex(calendar.closes.values, tz="UTC")
+    return market_opens, market_closes
+
+
+def _between(times: DatetimeIndex, start: Timestamp, end: Timestamp, include_start: bool = True) -> DatetimeIndex:
+    left = times.searchsorted(start, side='left' if include_start else 'right')
+    return times[left: times.searchsorted(end, side='right')]
+
+
+# 一个bar可以展开成的事件类型，取值同时也是同一个bar展开出来的事件的先后顺序
+_BAR_EVENT, _MARKET_OPEN_TICK_EVENT, _BAR_OPEN_TICK_EVENT, _MARKET_CLOSE_TICK_EVENT = range(4)
+
+
+def _bar_ticks(bar_config: BarEventConfig) -> List[Tuple[int, int]]:
+    """
+    根据bar的配置，确定一个bar除了bar事件之外还需要展开成哪些tick事件
+    :param bar_config:
+    :return: [(事件类型, 事件时间相对于bar的开始时间或者可见时间的偏移(纳秒))]
+    """
+    if not bar_config:
+        return []
+    ticks = []
+    if bar_config.market_open_as_tick and not bar_config.bar_open_as_tick:
+        ticks.append((_MARKET_OPEN_TICK_EVENT, bar_config.market_open_as_tick_delta.value))
+    if bar_config.bar_open_as_tick:
+        ticks.append((_BAR_OPEN_TICK_EVENT, bar_config.bar_open_as_tick_delta.value))
+    if bar_config.market_close_as_tick:
+        ticks.append((_MARKET_CLOSE_TICK_EVENT, bar_config.market_close_as_tick_delta.value))
+    return ticks
+
+
+def _expand_bars(visible_i8: np.ndarray, start_i8: np.ndarray, market_opens: np.ndarray, market_closes: np.ndarray,
+                 bar_ticks: List[Tuple[int, int]]) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    计算每个bar需要展开成哪些事件，全部使用numpy的向量化运算完成
+    :param visible_i8: bar的可见时间(纳秒)
+    :param start_i8: bar的开始时间(纳秒)
+    :param market_opens: 开盘时间(纳秒)
+    :param market_closes: 收盘时间(纳秒)
+    :param bar_ticks: 需要展开的tick事件，见_bar_ticks
+    :return: (事件类型, 事件对应的bar所在的行)，按照事件的时间排序，时间相同的事件保持bar的先后顺序
+    """
+    times = np.zeros((len(visible_i8), 4), dtype=np.int64)
+    selected = np.zeros((len(visible_i8), 4), dtype=bool)
+    times[:, _BAR_EVENT] = visible_i8
+    selected[:, _BAR_EVENT] = True
+    for kind, delta in bar_ticks:
+        if kind == _MARKET_OPEN_TICK_EVENT:
+            times[:, kind] = start_i8 + delta
+            selected[:, kind] = np.isin(start_i8, market_opens)
+        elif kind == _BAR_OPEN_TICK_EVENT:
+            times[:, kind] = start_i8 + delta
+            selected[:, kind] = True
+        else:
+            times[:, kind] = visible_i8 + delta
+            selected[:, kind] = np.isin(visible_i8, market_closes)
+    rows, kinds = np.nonzero(selected)
+    order = np.argsort(times[rows, kinds], kind='stable')
+    return kinds[order], rows[order]
+
+
+def _merge_events(*streams: Iterable[Event]) -> Iterator[Event]:
+    """
+    归并多个各自有序的事件流，排序键相同的事件按照事件流的先后顺序输出
+    注意必须指定key，heapq.merge直接比较事件时会先用==判断，Event没有定义__eq__，排序键相同的事件顺序会被打乱
+    :param streams:
+    :return:
+    """
+    return heapq.merge(*streams, key=lambda event: event._sort_key)
+
+
 class Rule(metaclass=ABCMeta):
 
     def is_match(self, calendar: TradingCalendar, dt: Timestamp):
         if not self._next_time:
             self._next_time = self.next_time(calendar, dt)
         if dt >= self._next_time:
-            self._next_time = self.next_time(calendar, dt)
+            # 触发时间是单调递增的，从上一次的触发时间往后推进即可
+            while dt >= self._next_time:
+                self._next_time = self.next_time(calendar, self._next_time)
             return True
         return False
 
-    @abstractmethod
+    @property
+    def pending_time(self) -> Timestamp:
+        """
+        is_match还没有触发的下一个触发时间，第一次调用is_match之前为None
+        :return:
+        """
+        return self._next_time
+
     def next_time(self, calendar: TradingCalendar, current_time: Timestamp) -> Timestamp:
+        """
+        当前时间之后的第一个触发时间
+        比如如果minute_offset=-30, 当前时间为盘前10分钟，则下一个触发时间是下一个交易日开盘前30分钟
+        :param calendar:
+        :param current_time:
+        :return:
+        """
+        base_times = self.base_times(calendar).asi8
+        offset = self.offset.value
+        idx = np.searchsorted(base_times, current_time.value - offset, side='right')
+        return Timestamp(base_times[idx] + offset, tz='UTC')
+
+    def generate_times(self, calendar: TradingCalendar, start: Timestamp, end: Timestamp) -> DatetimeIndex:
+        """
+        一次性生成(start, end]之间所有的触发时间，用于回测
+        :param calendar:
+        :param start:
+        :param end:
+        :return:
+        """
+        return _between(self.base_times(calendar) + self.offset, start, end, include_start=False)
+
+    @abstractmethod
+    def base_times(self, calendar: TradingCalendar) -> DatetimeIndex:
+        """
+        偏移之前的触发时间，比如开盘时间或者收盘时间
+        :param calendar:
+        :return:
+        """
         pass
 
     def __init__(self, minute_offset, second_offset):
         self._next_time = None
         self.minute_offset = minute_offset
         self.second_offset = second_offset
+        self.offset = Timedelta(minutes=minute_offset, seconds=second_offset)
 
 
 class MarketOpen(Rule):
-    def next_time(self, calendar: TradingCalendar, current_time: Timestamp) -> Timestamp:
-        # 因为TradingCalendar默认的开盘时间是开盘后一分钟，所以这里做一下调整
-        dt = calendar.next_open(current_time) + Timedelta(minutes=self.minute_offset - 1) + \
-             Timedelta(seconds=self.second_offset)
-        # 因为经过offset调整之后，这个时间可能在当前时间之前，比如如果minute_offset=-30, 当前时间为盘前10分钟，则下一个执行时间
-        # 是下下个开盘前的10分钟
-        if dt <= current_time:
-            dt = calendar.next_open(calendar.next_open(current_time)) + Timedelta(minutes=self.minute_offset - 1) \
-                 + Timedelta(seconds=self.second_offset)
-        return dt
+    def base_times(self, calendar: TradingCalendar) -> DatetimeIndex:
+        market_opens, _ = _market_times(calendar)
+        return market_opens
 
     def __init__(self, minute_offset=0, second_offset=0):
         super().__init__(minute_offset, second_offset)
 
 
 class MarketClose(Rule):
-    def next_time(self, calendar: TradingCalendar, current_time: Timestamp) -> Timestamp:
-        dt = calendar.next_close(current_time) + Timedelta(minutes=self.minute_offset) + \
-             Timedelta(seconds=self.second_offset)
-        if dt <= current_time:
-            dt = calendar.next_close(calendar.next_close(current_time)) + Timedelta(minutes=self.minute_offset) + \
-                 Timedelta(seconds=self.second_offset)
-        return dt
+    def base_times(self, calendar: TradingCalendar) -> DatetimeIndex:
+        _, market_closes = _market_times(calendar)
+        return market_closes
 
     def __init__(self, minute_offset=0, second_offset=0):
         super().__init__(minute_offset, second_offset)
@@ -104,6 +214,9 @@ class EventDataType(Enum):
 
 
 class EventDefinition(object):
+    __slots__ = ('ed_type', 'time_rule', 'ts_type_name', 'order', 'event_data_type', 'bar_config', 'sort_key',
+                 '_tag', '_bar_ticks')
+
     def __init__(self, ed_type: EventDefinitionType, time_rule: Rule = None, ts_type_name: str = None,
                  event_data_type: EventDataType = None, bar_config: BarEventConfig = None, order: int = 0):
         self.ed_type = ed_type
@@ -112,15 +225,12 @@ class EventDefinition(object):
         self.order = order
         self.event_data_type = event_data_type
         self.bar_config = bar_config
-
-    def compareTo(self, other: EventDefinition) -> int:
-        if self.ed_type == other.ed_type:
-            return self.order - other.order
-        else:
-            if self.ed_type == EventDefinitionType.TIME:
-                return 1
-            else:
-                return -1
+        # 同一时间的事件，数据事件排在时间事件之前，同类型的事件再按照order排序
+        self.sort_key = (1 if ed_type == EventDefinitionType.TIME else 0, order)
+        # 注册到引擎时分配，是回调在引擎回调列表中的下标
+        self._tag: int = None
+        # 提前根据配置确定bar需要展开成哪些tick事件，回测时不需要再逐个判断配置
+        self._bar_ticks = _bar_ticks(bar_config) if event_data_type == EventDataType.BAR else []
 
 
 class MockedEventProducer(object):
@@ -152,72 +262,101 @@ class EventProducer(TimeSeriesSubscriber):
         self.subscriber.on_event(Event(event_definition=ed, visible_time=data.visible_time, data=data))
 
     def history_events(self, scope: Scope, start: Timestamp, end: Timestamp) -> List[Event]:
-        total_events = []
-
-        # 组装时间事件
-        if len(self.time_event_definitions) > 0:
+        return list(self.iter_events(scope, start, end))
 
-            delta = Timedelta(minutes=1)
-            p = start
-            while p <= end:
-                for ed in self.time_event_definitions:
-                    if ed.time_rule.second_offset != 0:
-                        raise RuntimeError("回测过程中的时间事件不允许秒级偏移")
-                    if ed.time_rule.is_match(scope.trading_calendar, p):
-                        total_events.append(Event(ed, p, {}))
-
-                p += delta
-
-        # 组装数据事件
+    def iter_events(self, scope: Scope, start: Timestamp, end: Timestamp) -> Iterator[Event]:
+        """
+        按照时间顺序产生历史事件
+        每组时间规则和每个数据事件各自产生一个有序的事件流，再归并成一个事件流，不需要把所有的事件都放到内存中排序
+        :param scope:
+        :param start:
+        :param end:
+        :return:
+        """
+        sources = [self._time_events(scope, start, end, eds) for eds in self.time_event_groups.values()]
         if len(self.data_event_definitions) > 0:
-            market_opens = DatetimeIndex(scope.trading_calendar.opens.values, tz="UTC") - \
-                           Timedelta(minutes=1)
-            market_opens = market_opens[(market_opens >= start) & (market_opens <= end)]
-            market_closes = DatetimeIndex(scope.trading_calendar.closes.values, tz="UTC")
-            market_closes = market_closes[(market_closes >= start) & (market_closes <= end)]
-
-            for ed in self.data_event_definitions:
-                ts = BeanContainer.getBean(TimeSeriesRepo).find_one(ed.ts_type_name)
-                command = HistoryDataQueryCommand(start, end, scope.codes)
-                command.with_calendar(scope.trading_calendar)
-                df = ts.history_data(command, from_local=True)
-                for (visible_time, code), values in df.iterrows():
-                    data: Dict = values.to_dict()
-                    if ed.event_data_type == EventDataType.BAR:
-                        # 添加bar事件
-                        if "start_time" in data:
-                            start_time = data['start_time']
-                        else:
-                            start_time = data['date']
-
-                        bar = Bar(ed.ts_type_name, visible_time, code, start_time, data['open'], data['high'],
-                                  data['low'], data['close'], data['volume'])
-                        total_events.append(Event(ed, visible_time, bar))
-                        if ed.bar_config.market_open_as_tick and not ed.bar_config.bar_open_as_tick:
-                            if bar.start_time in market_opens:
-                                total_events.append(Event(ed, bar.start_time + ed.bar_config.market_open_as_tick_delta,
-                                                          Tick(ed.ts_type_name, visible_time, code,
-                                                               bar.open_price, -1)))
-
-                        if ed.bar_config.bar_open_as_tick:
-                            tick_visible_time = bar.start_time + ed.bar_config.bar_open_as_tick_delta
-                            total_events.append(Event(ed, tick_visible_time,
-                                                      Tick(ed.ts_type_name, tick_visible_time, code,
-                                                           bar.open_price, -1)))
-
-                        if ed.bar_config.market_close_as_tick:
-                            if bar.visible_time in market_closes:
-                                total_events.append(Event(ed, visible_time + ed.bar_config.market_close_as_tick_delta,
-                                                          Tick(ed.ts_type_name, visible_time, code,
-                                                               bar.close_price, -1)))
-                    elif ed.event_data_type == EventDataType.TICK:
-                        tick = Tick(ed.ts_type_name, visible_time, code, data['price'], data['size'])
-                        total_events.append(Event(ed, tick.visible_time,
-                                                  tick))
-                    else:
-                        total_events.append(Event(ed, visible_time, data))
-
-        return total_events
+            market_opens, market_closes = _market_times(scope.trading_calendar)
+            market_opens = _between(market_opens, start, end).asi8
+            market_closes = _between(market_closes, start, end).asi8
+            sources.extend([self._data_events(scope, start, end, ed, market_opens, market_closes)
+                            for ed in self.data_event_definitions])
+        return _merge_events(*sources)
+
+    def _time_events(self, scope: Scope, start: Timestamp, end: Timestamp,
+                     eds: List[EventDefinition]) -> Iterator[Event]:
+        # 按照交易日历一次性生成这组规则的触发时间，而不是逐分钟去匹配
+        time_rule = eds[0].time_rule
+        if time_rule.second_offset != 0:
+            raise RuntimeError("回测过程中的时间事件不允许秒级偏移")
+        times = time_rule.generate_times(scope.trading_calendar, start, end).tz_convert(start.tz)
+        for t in times:
+            for ed in eds:
+                yield Event(ed, t, {})
+
+    def _data_events(self, scope: Scope, start: Timestamp, end: Timestamp, ed: EventDefinition,
+                     market_opens: np.ndarray, market_closes: np.ndarray) -> Iterator[Event]:
+        ts = BeanContainer.getBean(TimeSeriesRepo).find_one(ed.ts_type_name)
+        command = HistoryDataQueryCommand(start, end, scope.codes)
+        command.with_calendar(scope.trading_calendar)
+        df = ts.history_data(command, from_local=True)
+        # 一次性把每一列转换成list，循环中只访问python对象，避免逐行访问pandas对象
+        visible_times = df.index.get_level_values(0)
+        codes = df.index.get_level_values(1).tolist()
+        if ed.event_data_type == EventDataType.BAR:
+            ts_type_name = ed.ts_type_name
+            if "start_time" in df.columns:
+                start_times = DatetimeIndex(df['start_time'])
+            else:
+                start_times = DatetimeIndex(df['date'])
+            opens, highs, lows = df['open'].tolist(), df['high'].tolist(), df['low'].tolist()
+            closes, volumes = df['close'].tolist(), df['volume'].tolist()
+
+            if not ed._bar_ticks:
+                # 只有bar事件，按照时间排序即可
+                rows = np.argsort(visible_times.asi8, kind='stable').tolist()
+                visible_times, start_times = visible_times.tolist(), start_times.tolist()
+                for row in rows:
+                    yield Event(ed, visible_times[row],
+                                Bar(ts_type_name, visible_times[row], codes[row], start_times[row], opens[row],
+                                    highs[row], lows[row], closes[row], volumes[row]))
+                return
+
+            bar_config = ed.bar_config
+            market_open_as_tick_delta = bar_config.market_open_as_tick_delta
+            bar_open_as_tick_delta = bar_config.bar_open_as_tick_delta
+            market_close_as_tick_delta = bar_config.market_close_as_tick_delta
+            # 先计算出需要添加的事件以及顺序，循环中只负责构造事件对象
+            kinds, bar_rows = _expand_bars(visible_times.asi8, start_times.asi8, market_opens, market_closes,
+                                           ed._bar_ticks)
+            visible_times, start_times = visible_times.tolist(), start_times.tolist()
+            for kind, row in zip(kinds.tolist(), bar_rows.tolist()):
+                if kind == _BAR_EVENT:
+                    yield Event(ed, visible_times[row],
+                                Bar(ts_type_name, visible_times[row], codes[row], start_times[row], opens[row],
+                                    highs[row], lows[row], closes[row], volumes[row]))
+                elif kind == _MARKET_OPEN_TICK_EVENT:
+                    yield Event(ed, start_times[row] + market_open_as_tick_delta,
+                                Tick(ts_type_name, visible_times[row], codes[row], opens[row], -1))
+                elif kind == _BAR_OPEN_TICK_EVENT:
+                    tick_visible_time = start_times[row] + bar_open_as_tick_delta
+                    yield Event(ed, tick_visible_time,
+                                Tick(ts_type_name, tick_visible_time, codes[row], opens[row], -1))
+                else:
+                    yield Event(ed, visible_times[row] + market_close_as_tick_delta,
+                                Tick(ts_type_name, visible_times[row], codes[row], closes[row], -1))
+        else:
+            # 保证事件流是按照时间排序的
+            rows = np.argsort(visible_times.asi8, kind='stable').tolist()
+            visible_times = visible_times.tolist()
+            if ed.event_data_type == EventDataType.TICK:
+                prices, sizes = df['price'].tolist(), df['size'].tolist()
+                for row in rows:
+                    yield Event(ed, visible_times[row],
+                                Tick(ed.ts_type_name, visible_times[row], codes[row], prices[row], sizes[row]))
+            else:
+                records = df.to_dict('records')
+                for row in rows:
+                    yield Event(ed, visible_times[row], records[row])
 
     def subscribe(self, subscriber: EventSubscriber):
         self.subscriber = subscriber
@@ -240,24 +379,30 @@ class EventProducer(TimeSeriesSubscriber):
         self.subscriber = None
         self.time_event_definitions = [ed for ed in self.event_definitions if ed.ed_type == EventDefinitionType.TIME]
         self.data_event_definitions = [ed for ed in self.event_definitions if ed.ed_type == EventDefinitionType.DATA]
+        # 类型和偏移都相同的时间规则，触发时间也相同，归为一组
+        self.time_event_groups: Dict[Tuple, List[EventDefinition]] = {}
+        for ed in self.time_event_definitions:
+            key = (type(ed.time_rule), ed.time_rule.minute_offset, ed.time_rule.second_offset)
+            self.time_event_groups.setdefault(key, []).append(ed)
+        # 同一组的事件触发时间相同，需要按照order排序，保证每组产生的事件流是有序的
+        for eds in self.time_event_groups.values():
+            eds.sort(key=lambda ed: ed.order)
         self.ts_type_name_to_ed = \
             {ed.ts_type_name: ed for ed in event_definitions if ed.ed_type == EventDefinitionType.DATA}
 
 
 class Event(object):
+    __slots__ = ('event_definition', 'visible_time', 'data', '_sort_key')
+
     def __init__(self, event_definition: EventDefinition, visible_time: Timestamp, data: object):
         self.event_definition = event_definition
         self.visible_time = visible_time
         self.data = data
+        sort_key = event_definition.sort_key
+        self._sort_key = (visible_time.value, sort_key[0], sort_key[1])
 
     def __lt__(self, other: Event):
-        if self.visible_time == other.visible_time:
-            if self.event_definition.compareTo(other.event_definition) < 0:
-                return True
-            else:
-                return False
-        else:
-            return self.visible_time < other.visible_time
+        return self._sort_key < other._sort_key
 
     def __str__(self):
         return '[Event]: event_definition:{ed}, visible_time:{visible_time}, data:{data}'. \
@@ -281,20 +426,27 @@ class TimeEventThread(Thread):
                 raise RuntimeError("wrong event definition type")
         self.time_event_conditions = time_event_conditions
         self.calendar = calendar
+        self.max_sleep = Timedelta(seconds=60)
 
     def run(self) -> None:
         while True:
+            sleep_time = Timedelta(seconds=1)
             try:
                 t: Timestamp = Timestamp.now(tz='Asia/Shanghai')
-                logging.info("当前时间:{}".format(t))
+                logging.debug("当前时间:%s", t)
                 for ed in self.time_event_conditions:
                     if ed.time_rule.is_match(self.calendar, t):
                         event = Event(ed, t, {})
                         self.subscriber.on_event(event)
-                time.sleep(1)
+                # 睡眠到最近的一个触发时间，但是不超过max_sleep，防止系统时间被调整之后错过事件
+                sleep_time = self.max_sleep
+                if len(self.time_event_conditions) > 0:
+                    next_time = min([ed.time_rule.pending_time for ed in self.time_event_conditions])
+                    sleep_time = min(next_time - Timestamp.now(tz='Asia/Shanghai'), self.max_sleep)
             except:
                 import traceback
                 logging.error("{}".format(traceback.format_exc()))
+            time.sleep(max(sleep_time.total_seconds(), 0))
 
 
 class DataPortal(TimeSeriesSubscriber):
@@ -406,13 +558,7 @@ class DataPortal(TimeSeriesSubscriber):
             return ret
 
     def set_current_price(self, event: Event, account: AbstractAccount, data_portal: DataPortal):
-        if isinstance(event.data, Bar):
-            self._current_price_map[event.data.code] = \
-                Price(event.data.code, event.data.close_price, event.visible_time)
-        elif isinstance(event.data, Tick):
-            self._current_price_map[event.data.code] = Price(event.data.code, event.data.price, event.visible_time)
-        else:
-            raise RuntimeError("wrong event data")
+        self._current_price_map[event.data.code] = event.data.to_price(event.visible_time)
 
     @alarm(level=AlarmLevel.ERROR, target="获取最新的买卖价")
     @retry(limit=10, interval=1)
@@ -602,39 +748,48 @@ class AbstractStrategy(OrderCallback, metaclass=ABCMeta):
         self.scope = scope
 
 class EventLine(object):
+    """
+    事件按照时间倒序保存，弹出最早的事件时只需要从列表末尾pop
+    """
 
     def __init__(self):
-        self.events = []
+        self.events: List[Event] = []
 
     def add_all(self, events: List[Event]):
-        self.events.extend(events)
-        self.events.sort()
+        # 只对新加入的事件排序，再和已有的事件归并，时间相同的事件保持加入的先后顺序
+        new_events = sorted(events)
+        if len(self.events) > 0:
+            new_events = list(_merge_events(reversed(self.events), new_events))
+        new_events.reverse()
+        self.events = new_events
 
     def pop_event(self) -> Event:
         if len(self.events) > 0:
-            return self.events.pop(0)
+            return self.events.pop()
         else:
             return None
 
 
 def calc_net_value(event: Event, account: AbstractAccount, data_portal: DataPortal):
-    if len(account.positions) > 0:
-        current_price: Mapping[str, Price] = data_portal.current_price(list(account.positions.keys()),
-                                                                       event.visible_time,
-                                                                       delay_allowed=Timedelta(seconds=20))
-        cp = {code: current_price[code].price for code in current_price.keys()}
-    else:
-        cp = {}
-    account.calc_net_value(cp, event.visible_time)
+    if not account.positions:
+        # 没有持仓的时候，净值就是现金，不需要获取最新价格
+        account.calc_net_value({}, event.visible_time)
+        return
+    # 实盘中持仓会在其他线程中被修改，这里需要复制一份持仓的代码
+    current_price: Mapping[str, Price] = data_portal.current_price(list(account.positions.keys()),
+                                                                   event.visible_time,
+                                                                   delay_allowed=Timedelta(seconds=20))
+    account.calc_net_value({code: price.price for code, price in current_price.items()}, event.visible_time)
 
 
 class Engine(EventSubscriber):
 
     def register_event(self, event_definition: EventDefinition,
                        callback: Callable[[Event, AbstractAccount, DataPortal], None]):
-        if event_definition in self.callback_map:
+        if event_definition in self.event_definitions:
             raise RuntimeError("wrong event definition")
-        self.callback_map[event_definition] = callback
+        event_definition._tag = len(self._callbacks)
+        self._callbacks.append(callback)
         self.event_definitions.append(event_definition)
 
     def on_event(self, event: Event):
@@ -673,22 +828,17 @@ class Engine(EventSubscriber):
                                             order=-10),
                             self.match)
 
-        event_line = EventLine()
-
         ep = EventProducer(self.event_definitions)
-        event_line.add_all(ep.history_events(strategy.scope, start, end))
 
         account = BacktestAccount(account_name, initial_cash).with_order_callback(strategy)
-        event: Event = event_line.pop_event()
-        while event is not None:
-            callback = self.callback_for(event.event_definition)
+        callbacks = self._callbacks
+        # 事件按照时间顺序逐个产生，不需要一次性全部放到内存中
+        for event in ep.iter_events(strategy.scope, start, end):
             try:
-                callback(event, account, data_portal)
+                callbacks[event.event_definition._tag](event, account, data_portal)
             except:
                 import traceback
                 logging.error("{}".format(traceback.format_exc()))
-
-            event = event_line.pop_event()
         # 存储以便后续分析用
         account.save()
         return account
@@ -717,7 +867,7 @@ class Engine(EventSubscriber):
             mocked_ep.start(strategy.scope)
 
     def __init__(self):
-        self.callback_map = {}
+        self._callbacks: List[Callable[[Event, AbstractAccount, DataPortal], None]] = []
         self.event_definitions = []
 
         self.account = None
@@ -725,7 +875,7 @@ class Engine(EventSubscriber):
         self.is_backtest = False
 
     def callback_for(self, event_definition: EventDefinition):
-        return self.callback_map[event_definition]
+        return self._callbacks[event_definition._tag]
 
     def is_unique_account(self, account_name):
 
@@ -136,6 +136,8 @@ class Asset(object):
 
 
 class TSData(object):
+    __slots__ = ('ts_type_name', 'visible_time', 'code', 'values')
+
     def __init__(self, ts_type_name: str, visible_time: Timestamp, code: str, values: Dict[str, object]):
         self.ts_type_name = ts_type_name
         self.visible_time = visible_time
@@ -149,8 +151,12 @@ class TSData(object):
         dt['code'] = self.code
         return dt
 
+    def to_price(self, time: Timestamp = None) -> Price:
+        raise RuntimeError("wrong ts_data type")
+
 
 class Bar(TSData):
+    __slots__ = ('start_time', 'open_price', 'high_price', 'low_price', 'close_price', 'volume')
 
     def __init__(self, ts_type_name: str, visible_time: Timestamp, code: str, start_time, open_price,
                  high_price, low_price, close_price, volume):
@@ -162,14 +168,26 @@ class Bar(TSData):
         self.volume = volume
         super().__init__(ts_type_name, visible_time, code, {})
 
+    def to_price(self, time: Timestamp = None) -> Price:
+        """
+        以收盘价作为最新价格
+        :param time: 价格的时间，默认是bar的可见时间
+        :return:
+        """
+        return Price(self.code, self.close_price, time if time is not None else self.visible_time)
+
 
 class Tick(TSData):
+    __slots__ = ('price', 'size')
 
     def __init__(self, ts_type_name: str, visible_time: Timestamp, code: str, price, size):
         self.price = price
         self.size = size
         super().__init__(ts_type_name, visible_time, code, {})
 
+    def to_price(self, time: Timestamp = None) -> Price:
+        return Price(self.code, self.price, time if time is not None else self.visible_time)
+
 
 class TimeSeriesDataRepo(object):
     @classmethod
@@ -0,0 +1,41 @@
+from unittest import TestCase
+
+from pandas._libs.tslibs.timestamps import Timestamp
+
+from se.domain2.engine.engine import Event, EventDefinition, EventDefinitionType, EventDataType, EventLine, \
+    _merge_events
+
+
+class TestMergeEvents(TestCase):
+
+    def test_same_sort_key_keeps_stream_order(self):
+        tick_ed = EventDefinition(EventDefinitionType.DATA, ts_type_name="tick", event_data_type=EventDataType.TICK)
+        other_ed = EventDefinition(EventDefinitionType.DATA, ts_type_name="other", event_data_type=EventDataType.OTHER)
+        times = [Timestamp("2021-01-04 14:30:00", tz="UTC")] * 3 + [Timestamp("2021-01-04 14:31:00", tz="UTC")]
+        tick_events = [Event(tick_ed, t, {}) for t in times]
+        other_events = [Event(other_ed, t, {}) for t in times]
+
+        merged = list(_merge_events(tick_events, other_events))
+
+        self.assertEqual(tick_events[:3] + other_events[:3] + tick_events[3:] + other_events[3:], merged)
+        self.assertEqual(merged, sorted(tick_events + other_events))
+
+
+class TestEventLine(TestCase):
+
+    def test_same_sort_key_keeps_add_order(self):
+        ed = EventDefinition(EventDefinitionType.DATA, ts_type_name="tick", event_data_type=EventDataType.TICK)
+        t = Timestamp("2021-01-04 14:30:00", tz="UTC")
+        first = [Event(ed, t, {}) for _ in range(3)]
+        second = [Event(ed, t, {}) for _ in range(3)]
+        event_line = EventLine()
+        event_line.add_all(first)
+        event_line.add_all(second)
+
+        popped = []
+        event = event_line.pop_event()
+        while event:
+            popped.append(event)
+            event = event_line.pop_event()
+
+        self.assertEqual(first + second, popped)